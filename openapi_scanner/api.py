@@ -1,32 +1,59 @@
-import cgi
-import copy
+import codecs
 import functools
+import hashlib
+import pickle
+import re
 import urllib.parse as urlparse
-from logging import getLogger
+from collections import deque
+from logging import DEBUG, getLogger
+from pathlib import Path
 from typing import Any, Optional
 
 import requests
 import yaml
 
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
 from . import __package_name__
-from .constants import USER_AGENT
+from .constants import UNDEFINED, USER_AGENT
+from .utils import json_loads, parse_content_type
 
 logger = getLogger(__package_name__)
 
 
 class Loader:
-    YAML_MIMES: list[str] = [
-        'text/vnd.yaml',
-        'application/yaml',
-        'application/x-yaml',
-        'text/x-yaml',
-    ]
+    YAML_MIMES: frozenset[str] = frozenset(
+        {
+            'text/vnd.yaml',
+            'application/yaml',
+            'application/x-yaml',
+            'text/x-yaml',
+        }
+    )
 
     YAML_EXTS: tuple[str, ...] = ('.yml', '.yaml')
 
-    def __init__(self, session: Optional[requests.Session] = None):
+    # Проверка первого значимого байта без копирования всего тела
+    JSON_START_RE: re.Pattern = re.compile(rb'\s*[{\[]')
+
+    # LibYAML парсит в разы быстрее чистого питона
+    _yaml_loader: type = YamlLoader
+
+    def __init__(
+        self,
+        session: Optional[requests.Session] = None,
+        cache_dir: None | Path = None,
+    ):
         self._session = session or self._create_session()
         self._cache = {}
+        # Разобранные схемы сохраняются между запусками и перепроверяются по
+        # ETag/Last-Modified
+        self._cache_dir = cache_dir
+        # Хосты, на которых нет JSON-версии YAML спецификации
+        self._yaml_only_hosts: set[str] = set()
 
     def _create_session(self) -> requests.Session:
         session = requests.session()
@@ -35,20 +62,133 @@ class Loader:
 
     def load(self, schema_url: str) -> dict[str, Any]:
         if schema_url not in self._cache:
-            r = self._session.get(schema_url)
-            ct, _ = cgi.parse_header(r.headers.get('content-type', ''))
-            if ct in self.YAML_MIMES or schema_url.endswith(self.YAML_EXTS):
-                schema = yaml.safe_load(r.text)
-            else:
-                schema = r.json()
-            self._cache[schema_url] = schema
+            self._cache[schema_url] = self._fetch(schema_url)
         return self._cache[schema_url]
 
+    def _fetch(self, schema_url: str) -> dict[str, Any]:
+        headers = {}
+        if cached := self._read_cache(schema_url):
+            url = cached['url']
+            if cached['etag']:
+                headers['If-None-Match'] = cached['etag']
+            if cached['last_modified']:
+                headers['If-Modified-Since'] = cached['last_modified']
+        else:
+            # JSON парсится на порядки быстрее YAML
+            url = self._find_json_variant(schema_url) or schema_url
+        r = self._session.get(url, headers=headers)
+        if cached and r.status_code == 304:
+            logger.debug('not modified: %s', url)
+            return cached['schema']
+        # Многие серверы не отдают ни ETag, ни Last-Modified. Тогда
+        # сравниваем хеш тела, чтобы не разбирать неизменную схему заново.
+        # Без кеша хеш не нужен
+        digest = (
+            hashlib.blake2b(r.content).hexdigest() if self._cache_dir else None
+        )
+        if cached and cached.get('digest') == digest and cached['url'] == url:
+            logger.debug('same content: %s', url)
+            schema = cached['schema']
+        else:
+            ct = parse_content_type(r.headers.get('content-type', ''))
+            schema = self._parse(
+                r.content,
+                ct in self.YAML_MIMES or url.endswith(self.YAML_EXTS),
+                url,
+            )
+        self._write_cache(
+            schema_url,
+            {
+                'url': url,
+                'etag': r.headers.get('etag'),
+                'last_modified': r.headers.get('last-modified'),
+                'digest': digest,
+                'schema': schema,
+            },
+        )
+        return schema
+
+    def _parse(self, content: bytes, is_yaml: bool, url: str) -> Any:
+        # orjson в отличие от json.loads не принимает BOM
+        if content.startswith(codecs.BOM_UTF8):
+            content = content[len(codecs.BOM_UTF8) :]
+        # Нередко по ссылке на .yaml на самом деле отдается JSON. JSON является
+        # подмножеством YAML, но JSON-парсер разбирает его в разы быстрее
+        if is_yaml and self.JSON_START_RE.match(content):
+            try:
+                return json_loads(content)
+            except ValueError:
+                pass
+        if not is_yaml:
+            return json_loads(content)
+        if not yaml.__with_libyaml__:
+            logger.warning(
+                'PyYAML is built without LibYAML, parsing %s may be slow', url
+            )
+        return yaml.load(content, Loader=self._yaml_loader)
+
+    def _get_cache_path(self, schema_url: str) -> Path:
+        digest = hashlib.blake2b(schema_url.encode()).hexdigest()[:32]
+        return self._cache_dir / f'{digest}.pickle'
+
+    def _read_cache(self, schema_url: str) -> None | dict[str, Any]:
+        if not self._cache_dir:
+            return None
+        try:
+            with self._get_cache_path(schema_url).open('rb') as fp:
+                return pickle.load(fp)
+        except FileNotFoundError:
+            return None
+        except (OSError, pickle.UnpicklingError, EOFError) as ex:
+            logger.warning('invalid cache for %s: %s', schema_url, ex)
+            return None
+
+    def _write_cache(self, schema_url: str, entry: dict[str, Any]) -> None:
+        if not self._cache_dir:
+            return
+        path = self._get_cache_path(schema_url)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_suffix('.tmp')
+            with tmp_path.open('wb') as fp:
+                pickle.dump(entry, fp, pickle.HIGHEST_PROTOCOL)
+            tmp_path.replace(path)
+        except OSError as ex:
+            logger.warning('can not write cache for %s: %s', schema_url, ex)
+
+    def _find_json_variant(self, schema_url: str) -> str | None:
+        if not schema_url.endswith(self.YAML_EXTS):
+            return None
+        host = urlparse.urlsplit(schema_url).netloc
+        if host in self._yaml_only_hosts:
+            return None
+        json_url = schema_url.rsplit('.', 1)[0] + '.json'
+        try:
+            r = self._session.head(json_url, allow_redirects=True)
+        except requests.RequestException:
+            r = None
+        # SPA на любой путь отдают 200 и html
+        if (
+            r is not None
+            and r.ok
+            and 'json' in parse_content_type(r.headers.get('content-type', ''))
+        ):
+            logger.debug('use json variant: %s', json_url)
+            return json_url
+        self._yaml_only_hosts.add(host)
+        return None
+
 
 class Dereferencer:
     def __init__(self, schema_url: str, loader: None | Loader = None):
         self._schema_url = schema_url
         self._loader = loader or Loader()
+        # Одни и те же компоненты встречаются в схеме десятки раз. Результат
+        # разыменования узла не зависит от пути к нему (при циклических
+        # ссылках бросается исключение), поэтому кешируем его по id()
+        self._memo: dict[int, Any] = {}
+        # ref -> (URL документа, ключи JSON Pointer)
+        self._ref_cache: dict[str, tuple[str, tuple[str, ...]]] = {}
 
     # Эти методы должны принадлежать парсеру, но парсер мы выбираем исходя из структуры
     # документа
@@ -57,43 +197,93 @@ class Dereferencer:
         return self._dereference(self._loader.load(self._schema_url))
 
     # Допустим, что $ref может быть в любом месте
-    def _dereference(self, o: Any, backrefs: list[str] = []) -> Any:
-        if isinstance(o, dict):
-            rv = {}
-            for k, v in o.items():
-                if k == '$ref':
-                    # Из-за наличия рекупсивных ссылок у пшеков, я думал, что я как-то
-                    # направильно организовал обход, пришлось дебажить. Kurwa!!!111
-                    if v in backrefs:
-                        logger.debug('backrefs=%r', backrefs)
-                        raise ValueError('Circular reference detected: %r', v)
-                    backrefs.append(v)
-                    rv.update(
-                        self._dereference(self.resolve_reference(v), backrefs)
-                    )
-                    assert backrefs.pop() == v
+    #
+    # Обходим схему без рекурсии: на больших схемах с глубоко вложенными allOf
+    # упираемся в лимит рекурсии, да и вызов функции в питоне дорогой. Фрейм
+    # стека: [узел, результат, итератор по элементам, $ref, текущий ключ]
+    def _dereference(self, o: Any) -> Any:
+        stack: deque[list[Any]] = deque()
+        # Ссылки, которые разыменовываются в данный момент
+        backrefs: set[str] = set()
+        rv = self._enter(o, None, stack)
+        while stack:
+            frame = stack[-1]
+            node, out, items, ref, key = frame
+            # Получили значение для текущего ключа
+            if rv is not UNDEFINED:
+                if key == '$ref':
+                    out.update(rv)
                     # Все после $ref должно игнорироваться
-                    break
-                rv[k] = self._dereference(v, backrefs)
-            return rv
+                    frame[2] = iter(())
+                elif isinstance(out, list):
+                    out.append(rv)
+                else:
+                    out[key] = rv
+                rv = UNDEFINED
+                continue
+            item = next(items, None)
+            if item is None:
+                stack.pop()
+                if ref is not None:
+                    backrefs.discard(ref)
+                self._memo[id(node)] = rv = out
+                continue
+            k, v = item
+            frame[4] = k
+            if k == '$ref':
+                # Из-за наличия рекупсивных ссылок у пшеков, я думал, что я как-то
+                # направильно организовал обход, пришлось дебажить. Kurwa!!!111
+                if v in backrefs:
+                    if logger.isEnabledFor(DEBUG):
+                        logger.debug('backrefs=%r', backrefs)
+                    raise ValueError('Circular reference detected: %r', v)
+                backrefs.add(v)
+                rv = self._enter(self.resolve_reference(v), v, stack)
+                # Узел уже разыменован или это скаляр
+                if rv is not UNDEFINED:
+                    backrefs.discard(v)
+            else:
+                rv = self._enter(v, None, stack)
+        return rv
+
+    def _enter(self, o: Any, ref: None | str, stack: deque[list[Any]]) -> Any:
+        if isinstance(o, dict):
+            if id(o) in self._memo:
+                return self._memo[id(o)]
+            stack.append([o, {}, iter(o.items()), ref, None])
+            return UNDEFINED
         if isinstance(o, list):
-            return [self._dereference(x, backrefs) for x in o]
+            if id(o) in self._memo:
+                return self._memo[id(o)]
+            stack.append([o, [], enumerate(o), ref, None])
+            return UNDEFINED
         assert isinstance(o, (int, float, str, bool))
         return o
 
     def resolve_reference(self, ref: str) -> Any:
-        url, path = ref.split('#', 2)
-        # У локальных ссылок path = ''
-        schema = self._loader.load(urlparse.urljoin(self._schema_url, url))
-        rv = schema
-        for key in path.split('/')[1:]:
-            key = key.replace('~1', '/').replace('~0', '~')
+        if ref not in self._ref_cache:
+            url, _, path = ref.partition('#')
+            # У локальных ссылок url = ''
+            self._ref_cache[ref] = (
+                urlparse.urljoin(self._schema_url, url),
+                tuple(
+                    key.replace('~1', '/').replace('~0', '~')
+                    for key in path.split('/')[1:]
+                ),
+            )
+        url, keys = self._ref_cache[ref]
+        rv = self._loader.load(url)
+        for key in keys:
             rv = rv[key]
         return rv
 
 
-def dereference(schema_url: str) -> dict[str, Any]:
-    return Dereferencer(schema_url=schema_url).dereference()
+def dereference(
+    schema_url: str, cache_dir: None | Path = None
+) -> dict[str, Any]:
+    return Dereferencer(
+        schema_url=schema_url, loader=Loader(cache_dir=cache_dir)
+    ).dereference()
 
 
 class BaseApi:
@@ -101,16 +291,18 @@ class BaseApi:
 
 
 class SwaggerApi(BaseApi):
-    ALLOWED_METHODS: set[str] = {
-        'get',
-        'head',
-        'post',
-        'put',
-        'patch',
-        'delete',
-        'options',
-        'trace',
-    }
+    ALLOWED_METHODS: frozenset[str] = frozenset(
+        {
+            'get',
+            'head',
+            'post',
+            'put',
+            'patch',
+            'delete',
+            'options',
+            'trace',
+        }
+    )
 
     def __init__(
         self,
@@ -119,45 +311,70 @@ class SwaggerApi(BaseApi):
     ):
         self._schema = schema
         self._schema_url = schema_url
+        parts = urlparse.urlsplit(schema_url)
+        self._schema_scheme = parts.scheme
+        self._schema_origin = f'{parts.scheme}://{parts.netloc}'
+        self._parameters_cache: dict[tuple[str, str], list[dict[str, Any]]] = {}
+        self._filtered_parameters_cache: dict[
+            tuple[str, str, str], list[dict[str, Any]]
+        ] = {}
 
     def get_server_urls(self) -> list[str]:
         base_path = self._schema.get('basePath', '/')
         if host := self._schema.get('host'):
+            # Без schemes используется схема, по которой загружена спецификация
+            schemes = self._schema.get('schemes') or [self._schema_scheme]
             return [
                 self.normalize_url(f'{scheme}://{host}{base_path}')
-                for scheme in self._schema['schemes']
+                for scheme in schemes
             ]
         return [self.normalize_url(base_path)]
 
     def normalize_url(self, url: str) -> str:
+        # urljoin каждый раз разбирает оба URL, а basePath почти всегда
+        # абсолютный путь
+        if url.startswith(('http://', 'https://')):
+            return url.rstrip('/')
+        if url.startswith('/') and not url.startswith('//'):
+            return f'{self._schema_origin}{url}'.rstrip('/')
         return urlparse.urljoin(self._schema_url, url).rstrip('/')
 
     def get_paths(self) -> list[str]:
         return list(self._schema['paths'].keys())
 
     def get_operations(self, path: str) -> list[str]:
-        return list(
-            set(self._schema['paths'][path].keys()) & self.ALLOWED_METHODS
-        )
+        # Сохраняем порядок операций как в схеме
+        return [
+            m for m in self._schema['paths'][path] if m in self.ALLOWED_METHODS
+        ]
 
     def get_parameters(self, path: str, operation: str) -> list[dict[str, Any]]:
         assert operation in self.ALLOWED_METHODS
-        path_object = self._schema['paths'][path]
-        defaults = path_object.get('parameters', {})
-        path_item = path_object[operation]
-        params = path_item.get('parameters', {})
-        params = self._override_parameters(defaults, params)
-        return copy.deepcopy(params)
+        key = (path, operation)
+        if key not in self._parameters_cache:
+            path_object = self._schema['paths'][path]
+            defaults = path_object.get('parameters', {})
+            path_item = path_object[operation]
+            params = path_item.get('parameters', {})
+            self._parameters_cache[key] = self._override_parameters(
+                defaults, params
+            )
+        # Объекты схемы не копируются: вызывающий код их только читает
+        return self._parameters_cache[key]
 
     def filter_parameters(
         self, path: str, operation: str, location: str
     ) -> list[dict[str, Any]]:
-        return list(
-            filter(
-                lambda x: x['in'] == location,
-                self.get_parameters(path, operation),
+        # Для каждой операции параметры запрашиваются по всем расположениям
+        key = (path, operation, location)
+        if key not in self._filtered_parameters_cache:
+            self._filtered_parameters_cache[key] = list(
+                filter(
+                    lambda x: x['in'] == location,
+                    self.get_parameters(path, operation),
+                )
             )
-        )
+        return self._filtered_parameters_cache[key]
 
     get_path_parameters = functools.partialmethod(
         filter_parameters, location='path'
@@ -177,11 +394,11 @@ class SwaggerApi(BaseApi):
 
     def has_payload(self, path: str, operation: str) -> bool:
         parameters = self.get_parameters(path, operation)
-        return any(lambda x: x['in'] in ('body', 'formData'), parameters)
+        return any(x['in'] in ('body', 'formData') for x in parameters)
 
     def has_formdata(self, path: str, operation: str) -> bool:
         parameters = self.get_parameters(path, operation)
-        return any(lambda x: x['in'] == 'formData', parameters)
+        return any(x['in'] == 'formData' for x in parameters)
 
     def get_payload_mimes(self, path: str, operation: str) -> list[str]:
         # Принимаемые типы можно объявить в корне и переопределить в Operation
@@ -194,10 +411,13 @@ class SwaggerApi(BaseApi):
     def _override_parameters(
         self, defaults: list[dict[str, Any]], overrides: list[dict[str, Any]]
     ) -> list[dict[str, Any]]:
-        make_key = lambda x: (x['name'], x['in'])
-        tmp: list[tuple[str, str], Any] = {make_key(v): v for v in defaults}
-        for v in overrides:
-            tmp[make_key(v)] = v
+        # Обычно общих параметров у пути нет или операция их не переопределяет
+        if not defaults or not overrides:
+            return list(overrides or defaults)
+        # Параметр операции заменяет общий с тем же именем и расположением
+        tmp: dict[tuple[str, str], Any] = {
+            (v['name'], v['in']): v for v in (*defaults, *overrides)
+        }
         return list(tmp.values())
 
 
@@ -219,7 +439,7 @@ class OpenApi(SwaggerApi):
         rv = self._schema['paths'][path][operation].get('requestBody', {})
         if mime:
             rv = rv.get('content', {}).get(mime)
-        return copy.deepcopy(rv)
+        return rv
 
     def get_payload_mimes(self, path: str, operation: str) -> list[str]:
         return list(
@@ -239,8 +459,8 @@ class OpenApi(SwaggerApi):
 # - https://coda.io/apis/v1/openapi.json (3)
 # - https://georg.nrm.se/api/swagger.json (2)
 # - https://michael1011.at/git/michael1011/market-maker-bot/src/branch/feat/reserved-balance/src/proto/xudrpc.swagger.json (2)
-def resolve(schema_url: str) -> BaseApi:
-    schema = dereference(schema_url)
+def resolve(schema_url: str, cache_dir: None | Path = None) -> BaseApi:
+    schema = dereference(schema_url, cache_dir=cache_dir)
     if 'swagger' in schema:
         return SwaggerApi(schema=schema, schema_url=schema_url)
     if 'openapi' in schema:
@@ -1,6 +1,12 @@
 import asyncio
 import logging
 import sys
+from pathlib import Path
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 from . import __doc__, __package_name__, __version__
 from .scanner import OpenApiVulnScanner
@@ -29,7 +35,7 @@ def _parse_args(argv: list[str]) -> argparse.Namespace:
         '--rate-limit',
         '--rate',
         default=100,
-        help='requests per minute rate limit',
+        help='requests per minute rate limit, 0 to disable',
         type=int,
     )
     parser.add_argument(
@@ -45,6 +51,22 @@ def _parse_args(argv: list[str]) -> argparse.Namespace:
         help='client timeout',
         type=float,
     )
+    parser.add_argument(
+        '--cache-dir',
+        help='directory to cache parsed schemas between runs',
+        type=Path,
+    )
+    parser.add_argument(
+        '--seed',
+        help='random seed for reproducible parameter values',
+        type=int,
+    )
+    parser.add_argument(
+        '--max-body-fields',
+        default=32,
+        help='max number of request body fields to check per operation',
+        type=int,
+    )
     parser.add_argument(
         '-v',
         '--verbose',
@@ -64,12 +86,17 @@ def main(argv: list[str] = sys.argv[1:]) -> None:
     log_levels = ['WARNING', 'INFO', 'DEBUG']
     lvl = log_levels[min(args.verbose, len(log_levels) - 1)]
     logger.setLevel(lvl)
-    asyncio.run(
+    # Цикл событий на libuv заметно быстрее стандартного
+    run = uvloop.run if uvloop else asyncio.run
+    run(
         OpenApiVulnScanner.run(
             args.url,
             headers=dict(map(lambda x: x.split(':', 2), args.header)),
             timeout=args.timeout,
             rate_limit=args.rate_limit,
             num_workers=args.workers,
+            cache_dir=args.cache_dir,
+            seed=args.seed,
+            max_body_fields=args.max_body_fields,
         )
     )
@@ -1,27 +1,64 @@
 import asyncio
+import contextlib
+import datetime
+import functools
+import itertools
 import logging
 import random
+import re
+import sys
 import urllib.parse as urlparse
 import uuid
-from asyncio import Queue
-from json import dumps
-from typing import Any, Awaitable, Callable, Iterable, Optional
+from collections import ChainMap
+from pathlib import Path
+from typing import Any, Iterator, Mapping, Optional
 
 import aiohttp
 from aiohttp.typedefs import LooseHeaders
-from aiolimiter import AsyncLimiter
 from multidict import CIMultiDict
+from yarl import URL
 
 from . import __package_name__, __version__, api
 from .constants import USER_AGENT
-from .utils import random_datetime
-
-# from copy import deepcopy
+from .utils import TokenBucket, json_dumps_line, json_loads, random_datetime
 
 logger = logging.getLogger(__package_name__)
 
+# (индекс шаблона, часть запроса, ключ, внедряемое значение)
+Task = tuple[int, str, str, str]
+
 
 class OpenApiVulnScanner:
+    # Находки копятся в буфере и пишутся в stdout пачками
+    OUTPUT_BUFFER_SIZE: int = 64 * 1024
+    OUTPUT_FLUSH_INTERVAL: float = 0.1
+
+    PATH_PARAM_RE: re.Pattern = re.compile(r'\{([^}]+)\}')
+
+    # Методы, для которых проверяется тело запроса
+    BODY_METHODS: frozenset[str] = frozenset({'patch', 'post', 'put'})
+
+    STRING_CHOICES: tuple[str, ...] = ('foo', 'bar', 'baz', 'quix')
+
+    # Сколько заранее сгенерировать uuid и дат. Уникальность значений для
+    # проверок не важна
+    VALUE_POOL_SIZE: int = 64
+
+    # Верхняя граница генерируемых дат при заданном seed
+    SEEDED_MAX_DATETIME: datetime.datetime = datetime.datetime(2020, 1, 1)
+
+    # Ответы больше этого размера не дочитываем и не разбираем
+    MAX_BODY_SIZE: int = 1 << 20
+
+    # Поля тела, которые вероятнее всего попадают в запросы к БД, проверяем
+    # первыми. id ищем только целым словом (id, user_id, userId, userID),
+    # иначе под него попадают valid, width, hidden и т.п.
+    BODY_FIELD_PRIORITY_RE: re.Pattern = re.compile(
+        r'(?:^|_)(?:id|ID)$|[a-z0-9]I[dD]$'
+        r'|(?:^|_)(?i:user|email|name|query|search)'
+        r'|[a-z0-9](?:User|Email|Name|Query|Search)'
+    )
+
     def __init__(
         self,
         schema_url: str,
@@ -30,151 +67,330 @@ class OpenApiVulnScanner:
         headers: Optional[LooseHeaders] = None,
         rate_limit: Optional[float] = None,
         num_workers: int = 10,
+        cache_dir: Optional[Path] = None,
+        seed: Optional[int] = None,
+        max_body_fields: int = 32,
+        openapi: Optional[api.BaseApi] = None,
     ):
-        self._api = api.resolve(schema_url)
+        self._api = openapi or api.resolve(schema_url, cache_dir=cache_dir)
+        # Используется в каждом запросе
+        self._server_url = self._api.get_server_urls()[0]
+        # URL собирается из уже закодированных частей, и aiohttp не нужно
+        # заново разбирать и кодировать строку в каждом запросе
+        self._base_url = URL(self._server_url)
+        # Путь собирается уже закодированным, поэтому и основу берем в
+        # закодированном виде
+        self._base_path = self._base_url.raw_path.rstrip('/')
         self._schema_url = schema_url
         self._session = session
-        self._headers = CIMultiDict(headers or {})
-        self._headers.setdefault(
-            'User-Agent',
-            USER_AGENT,
+        headers = self._make_headers(headers)
+        # Заголовки, уже заданные по умолчанию у сессии, aiohttp подставит сам.
+        # Остальные приходится сливать с заголовками каждого запроса
+        if session is not None:
+            headers = CIMultiDict(
+                (k, v)
+                for k, v in headers.items()
+                if session.headers.get(k) != v
+            )
+        self._headers = headers
+        # rate_limit - запросов в минуту, 0 - без ограничения (число
+        # одновременных запросов все равно ограничено числом воркеров)
+        if rate_limit is None:
+            rate_limit = 100
+        self._rate_limiter = (
+            TokenBucket(rate_limit / 60, rate_limit) if rate_limit > 0 else None
         )
-        self._rate_limiter = AsyncLimiter(rate_limit or 100)
         self._num_workers = num_workers
+        # У некоторых операций в теле сотни полей, проверяем не больше стольких
+        self._max_body_fields = max_body_fields
+        self._fuzz_cache: dict[int | tuple[int, ...], Any] = {}
+        # С одинаковым seed генерируются одни и те же значения параметров
+        self._rng = random.Random(seed)
+        # Строки по кругу: результат не зависит от генератора случайных чисел
+        self._strings = itertools.cycle(self.STRING_CHOICES)
+        # now() менялось бы от запуска к запуску, поэтому с seed даты берутся
+        # из фиксированного интервала
+        end = None if seed is None else self.SEEDED_MAX_DATETIME
+        datetimes = [
+            random_datetime(end=end, rng=self._rng)
+            for _ in range(self.VALUE_POOL_SIZE)
+        ]
+        self._datetime_pool = tuple(map(str, datetimes))
+        self._date_pool = tuple(str(x.date()) for x in datetimes)
+        self._uuid_pool = tuple(
+            str(uuid.UUID(int=self._rng.getrandbits(128), version=4))
+            for _ in range(self.VALUE_POOL_SIZE)
+        )
+        self._templates: list[dict[str, Any]] = []
+        self._out_buf = bytearray()
+        # Буфер заполнен, пора писать
+        self._out_ready = asyncio.Event()
+
+    @staticmethod
+    def _make_headers(headers: Optional[LooseHeaders]) -> CIMultiDict:
+        headers = CIMultiDict(headers or {})
+        headers.setdefault('User-Agent', USER_AGENT)
+        return headers
+
+    @classmethod
+    def create_session(
+        cls,
+        timeout: float = 60,
+        num_workers: int = 10,
+        headers: Optional[LooseHeaders] = None,
+    ) -> aiohttp.ClientSession:
+        # Все запросы идут на один хост: держим соединения открытыми, чтобы
+        # не тратить время на TCP/TLS рукопожатие перед каждой проверкой
+        connector = aiohttp.TCPConnector(
+            ssl=False,
+            limit=num_workers,
+            limit_per_host=num_workers,
+            keepalive_timeout=75,
+            ttl_dns_cache=300,
+            enable_cleanup_closed=True,
+        )
+        return aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=timeout),
+            headers=cls._make_headers(headers),
+            # Ответы маленькие, распаковка gzip обходится дороже
+            skip_auto_headers={'Accept-Encoding'},
+            # Куки, выставленные одной проверкой, не должны влиять на другие
+            cookie_jar=aiohttp.DummyCookieJar(),
+            trust_env=False,
+        )
 
     @classmethod
     async def run(
-        cls, schema_url: str, timeout: float = 60, **kwargs: dict[str, Any]
+        cls,
+        schema_url: str,
+        timeout: float = 60,
+        num_workers: int = 10,
+        session: Optional[aiohttp.ClientSession] = None,
+        cache_dir: Optional[Path] = None,
+        **kwargs: dict[str, Any],
     ) -> None:
-        async with aiohttp.ClientSession(
-            connector=aiohttp.TCPConnector(verify_ssl=False),
-            timeout=aiohttp.ClientTimeout(total=timeout),
+        # Загрузка и разбор схемы блокирующие (requests, yaml), выполняем их в
+        # отдельном потоке, чтобы не останавливать event loop
+        openapi = await asyncio.to_thread(
+            api.resolve, schema_url, cache_dir=cache_dir
+        )
+        # Переданную сессию не закрываем: ее можно использовать для
+        # нескольких сканирований подряд
+        async with (
+            contextlib.nullcontext(session)
+            if session
+            else cls.create_session(
+                timeout, num_workers, headers=kwargs.get('headers')
+            )
         ) as session:
-            await cls(schema_url=schema_url, session=session, **kwargs).scan()
+            await cls(
+                schema_url=schema_url,
+                session=session,
+                num_workers=num_workers,
+                openapi=openapi,
+                **kwargs,
+            ).scan()
 
     async def _request(
         self,
         method: str,
-        url: str,
+        url: str | URL,
         params: Any = None,
         *,
         data: Any = None,
         json: Any = None,
         headers: Any = None,
         cookies: Any = None,
-    ) -> aiohttp.ClientResponse:
+    ) -> tuple[int, str, None | bytes]:
         method = method.upper()
-        req_headers = self._headers.copy()
-        req_headers.update(headers or {})
-        async with self._rate_limiter:
-            response = await self._session.request(
-                method,
-                url,
-                params=self._normalize_query_params(params) if params else None,
-                json=json,
-                data=data,
-                cookies=cookies,
-                headers=req_headers,
-            )
+        # Общие заголовки обычно заданы у сессии, а у большинства операций нет
+        # параметров-заголовков, и тогда сливать нечего. aiohttp сам копирует
+        # переданные заголовки, поэтому общие можно отдавать как есть
+        if not self._headers:
+            req_headers = headers or None
+        elif headers:
+            req_headers = self._headers.copy()
+            req_headers.update(headers)
+        else:
+            req_headers = self._headers
+        if self._rate_limiter:
+            await self._rate_limiter.acquire()
+        async with self._session.request(
+            method,
+            url,
+            params=self._normalize_query_params(params),
+            json=json,
+            data=data,
+            cookies=cookies,
+            headers=req_headers,
+        ) as response:
+            # Тело читаем полностью, чтобы соединение сразу вернулось в пул.
+            # Огромные ответы (выгрузки, файлы) не держим в памяти: дешевле
+            # переподключиться, aiohttp закроет соединение с непрочитанным телом
+            if (response.content_length or 0) > self.MAX_BODY_SIZE:
+                body = None
+            else:
+                # Content-Length может и не быть (chunked), поэтому читаем не
+                # больше лимита
+                try:
+                    await response.content.readexactly(self.MAX_BODY_SIZE + 1)
+                    body = None
+                except asyncio.IncompleteReadError as ex:
+                    # Тело закончилось раньше лимита
+                    body = ex.partial
             logger.debug('%s %s [%s]', method, response.url, response.status)
-            return response
+            return response.status, response.content_type, body
 
-    def _normalize_query_params(self, params: dict[str, Any]) -> dict[str, Any]:
+    def _normalize_query_params(
+        self, params: None | dict[str, Any]
+    ) -> None | dict[str, Any]:
         # TypeError: Invalid variable type: value should be str, int or float, got True of type <class 'bool'>
         # https://github.com/aio-libs/yarl#why-isnt-boolean-supported-by-the-url-query-api
         # >>> [1, 2][True]
         # 2
+        if not params:
+            return None
+        # Обычно булевых значений нет, и копировать словарь незачем.
+        # type() is быстрее isinstance, а наследников bool не бывает
+        if not any(type(v) is bool for v in params.values()):
+            return params
         return {
             # k: ['false', 'true'][v] if isinstance(v, bool) else v
-            k: int(v) if isinstance(v, bool) else v
+            k: int(v) if type(v) is bool else v
             for k, v in params.items()
         }
 
     @property
     def server_url(self) -> str:
-        return self._api.get_server_urls()[0]
+        return self._server_url
 
     async def scan(self) -> None:
-        q = Queue()
         logger.info('scanning started')
-        self._generate_tasks(q)
-        logger.debug('queue size: %d', q.qsize())
-        workers = [self._worker(q, i) for i in range(self._num_workers)]
-        await asyncio.gather(*workers)
-        await q.join()
+        stop_flusher = asyncio.Event()
+        flusher = asyncio.create_task(self._output_flusher(stop_flusher))
+        # Воркеры разбирают задачи из общего генератора: одновременно живут
+        # только num_workers корутин, а задачи генерируются по мере отправки
+        # запросов
+        tasks = self._generate_tasks()
+        workers = [
+            asyncio.create_task(self._worker(tasks, i))
+            for i in range(self._num_workers)
+        ]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            # gather не отменяет остальные воркеры, если один из них упал.
+            # Останавливаем их до сброса буфера, иначе их находки потеряются
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            # Найденное не должно теряться при ошибке или Ctrl+C
+            stop_flusher.set()
+            self._out_ready.set()
+            try:
+                await flusher
+            except asyncio.CancelledError:
+                pass
+            if self._out_buf:
+                self._write_stdout(bytes(self._out_buf))
+                self._out_buf.clear()
         logger.info('scanning finished')
 
-    async def _worker(self, q: Queue, index: int) -> None:
+    async def _worker(self, tasks: Iterator[Task], index: int) -> None:
         logger.info('worker #%s started', index)
-        while q.qsize():
-            try:
-                task = await q.get()
-                logger.debug(task)
-                await self._test_vuln(**task)
-            except Exception as ex:
-                logger.exception(ex)
-            finally:
-                q.task_done()
+        # next() у генератора не отдает управление, поэтому воркеры не могут
+        # получить одну и ту же задачу
+        for task in tasks:
+            logger.debug(task)
+            await self._test_vuln(*self._build_request(*task))
         logger.info('worker #%s finished', index)
 
+    async def _output_flusher(self, stop: asyncio.Event) -> None:
+        # Единственный писатель в stdout: воркеры только дописывают находки
+        # в буфер и не ждут завершения записи
+        while not stop.is_set():
+            try:
+                await asyncio.wait_for(
+                    self._out_ready.wait(), self.OUTPUT_FLUSH_INTERVAL
+                )
+            except asyncio.TimeoutError:
+                pass
+            self._out_ready.clear()
+            await self._flush_output()
+
+    def _write_output(self, data: bytes) -> None:
+        self._out_buf += data
+        if len(self._out_buf) >= self.OUTPUT_BUFFER_SIZE:
+            self._out_ready.set()
+
+    async def _flush_output(self) -> None:
+        if not self._out_buf:
+            return
+        data = bytes(self._out_buf)
+        self._out_buf.clear()
+        # Запись в stdout блокирующая, не тормозим ею event loop
+        await asyncio.get_running_loop().run_in_executor(
+            None, self._write_stdout, data
+        )
+
+    @staticmethod
+    def _write_stdout(data: bytes) -> None:
+        sys.stdout.buffer.write(data)
+        sys.stdout.buffer.flush()
+
     async def _test_vuln(
         self,
         method: str,
-        path: str,
-        params: dict[str, Any],
+        url: URL,
         query: dict[str, Any],
         json: dict[str, Any],
         headers: dict[str, Any],
     ) -> None:
         try:
-            url: str = (
-                f'{self.server_url}{self._replace_path_params(path, params)}'
-            )
-            response = await self._request(
+            status, content_type, body = await self._request(
                 method, url, query, json=json, headers=headers
             )
-            has_error = response.status >= 500
-            try:
-                parsed = await response.json()
-            except:
-                # Говно на PHP сгенерирует что-то типа:
-                # <br />\n<b>Warning</b>: ...
-                # Django же покажет стандартную html страницу, что тоже приведет к
-                # ошибке парсинга.
-                parsed = None
+            has_error = status >= 500
+            # Говно на PHP сгенерирует что-то типа:
+            # <br />\n<b>Warning</b>: ...
+            # Django же покажет стандартную html страницу. Такие ответы даже не
+            # пытаемся разобрать
+            parsed = None
+            if 'json' not in content_type:
                 has_error = True
+            elif body is not None:
+                try:
+                    parsed = self._parse_json(body)
+                except ValueError:
+                    has_error = True
             if not has_error:
                 return
-            print(
-                dumps(
-                    dict(
-                        method=method,
-                        url=url,
-                        query=query,
-                        data=json,
-                        headers=headers,
-                        response={
-                            'status_code': response.status,
+            self._write_output(
+                json_dumps_line(
+                    {
+                        'method': method,
+                        'url': str(url),
+                        'query': query,
+                        'data': json,
+                        'headers': headers,
+                        'response': {
+                            'status_code': status,
                             'data': parsed,
                         },
-                    )
-                ),
-                flush=True,
+                    }
+                )
             )
         except Exception as ex:
             logger.exception(ex)
 
-    def _generate_tasks(
-        self,
-        q: Queue,
-    ) -> Iterable[
-        Callable[
-            [str, str, dict[str, Any], dict[str, Any], dict[str, Any]],
-            Awaitable[None],
-        ]
-    ]:
+    def _generate_tasks(self) -> Iterator[Task]:
+        # Хранятся только хеши подписей запросов: сами подписи содержат
+        # repr всех параметров операции. Вероятность коллизии 64-битных хешей
+        # для реальных схем пренебрежимо мала
+        seen: set[int] = set()
         for path in self._api.get_paths():
-            logger.debug(f'{path=}')
+            logger.debug('path=%r', path)
             for method in self._api.get_operations(path):
                 params = self._api.get_path_parameters(path, method)
                 query = self._api.get_query_parameters(path, method)
@@ -188,7 +404,7 @@ class OpenApiVulnScanner:
                 # only one body parameter, although the operation may have other
                 # parameters (path, query, header).
                 json = None
-                if method in ['patch', 'post', 'put']:
+                if method in self.BODY_METHODS:
                     if isinstance(self._api, api.OpenApi):
                         json = self._api.get_request_body(
                             path, method, 'application/json'
@@ -206,112 +422,215 @@ class OpenApiVulnScanner:
                         logger.warning('%s: %s: no request body', path, method)
                         continue
 
+                body_schema = json
                 # Проверяем каждый параметр по очереди
                 params = self._fuzz_data(params)
                 headers = self._fuzz_data(headers)
                 query = self._fuzz_data(query)
                 json = self._fuzz_data(json) or {}
 
-                for k, v in params.items():
-                    params_copy = params.copy()
-                    params_copy[k] = self._inject(v)
-                    q.put_nowait(
-                        {
-                            'method': method,
-                            'path': path,
-                            'params': params_copy,
-                            'query': query,
-                            'json': json,
-                            'headers': headers,
-                        }
+                # В задачу кладем только измененное значение, остальное
+                # берется из общего для всех проверок операции шаблона
+                template_id = len(self._templates)
+                rendered_path = self._replace_path_params(path, params)
+                self._templates.append(
+                    {
+                        'method': method,
+                        'path': path,
+                        # URL меняется только при проверке параметров пути
+                        'url': self._make_url(rendered_path),
+                        'params': params,
+                        'query': query,
+                        'json': json,
+                        'headers': headers,
+                    }
+                )
+                # Разные пути в схеме могут давать одинаковые запросы (например,
+                # /items/{id} и /items/{item_id}), а заголовки отличаться только
+                # регистром. Одинаковые запросы не отправляем повторно
+                lowered_headers = {k.lower(): v for k, v in headers.items()}
+                parts = {
+                    'params': rendered_path,
+                    'headers': repr(lowered_headers),
+                    'query': repr(query),
+                    'json': repr(json),
+                }
+                # json может иметь вложенные поля, так неправильно проверять
+                for location in parts:
+                    fields = self._templates[template_id][location]
+                    keys = (
+                        self._select_body_fields(body_schema, fields)
+                        if location == 'json' and fields
+                        else fields
                     )
+                    for k in keys:
+                        value = self._inject(fields[k])
+                        # Подпись описывает запрос целиком: измененная часть
+                        # берется вместе с остальными значениями в ней
+                        if location == 'params':
+                            changed = self._replace_path_params(
+                                path, ChainMap({k: value}, params)
+                            )
+                        elif location == 'headers':
+                            changed = repr(
+                                {**lowered_headers, k.lower(): value}
+                            )
+                        else:
+                            changed = repr({**fields, k: value})
+                        signature = (
+                            method,
+                            *{**parts, location: changed}.values(),
+                        )
+                        key = hash(signature)
+                        if key in seen:
+                            logger.debug('duplicate request: %r', signature)
+                            continue
+                        seen.add(key)
+                        yield template_id, location, k, value
 
-                for k, v in headers.items():
-                    headers_copy = headers.copy()
-                    headers_copy[k] = self._inject(v)
-                    q.put_nowait(
-                        {
-                            'method': method,
-                            'path': path,
-                            'params': params,
-                            'query': query,
-                            'json': json,
-                            'headers': headers_copy,
-                        }
-                    )
+    def _parse_json(self, body: bytes) -> Any:
+        # Ведем себя как ClientResponse.json(). isspace() в отличие от strip()
+        # не копирует тело ответа
+        if not body or body.isspace():
+            return None
+        return json_loads(body)
 
-                for k, v in query.items():
-                    query_copy = query.copy()
-                    query_copy[k] = self._inject(v)
-                    q.put_nowait(
-                        {
-                            'method': method,
-                            'path': path,
-                            'params': params,
-                            'query': query_copy,
-                            'json': json,
-                            'headers': headers,
-                        }
-                    )
+    def _select_body_fields(
+        self, schema: dict[str, Any], fields: dict[str, Any]
+    ) -> list[str]:
+        properties = schema.get('schema', schema).get('properties') or {}
+        # Подстановка кавычки в boolean или enum до SQL почти никогда не
+        # доходит: такие значения проверяются раньше
+        keys = [
+            k
+            for k in fields
+            if 'enum' not in properties.get(k, {})
+            and properties.get(k, {}).get('type') != 'boolean'
+        ]
+        # Сортировка устойчивая: в остальном сохраняется порядок из схемы
+        keys.sort(key=lambda k: not self.BODY_FIELD_PRIORITY_RE.search(k))
+        return keys[: self._max_body_fields]
 
-                # может иметь вложенные поля, так неправильно проверять
-                for k, v in json.items():
-                    json_copy = json.copy()
-                    json_copy[k] = self._inject(v)
-                    q.put_nowait(
-                        {
-                            'method': method,
-                            'path': path,
-                            'params': params,
-                            'query': query,
-                            'json': json_copy,
-                            'headers': headers,
-                        }
-                    )
+    def _build_request(
+        self, template_id: int, location: str, key: str, value: str
+    ) -> tuple[str, URL, dict, dict, dict]:
+        template = self._templates[template_id]
+        url = template['url']
+        query = template['query']
+        json = template['json']
+        headers = template['headers']
+        # Копируется только словарь с измененным значением. Параметры пути
+        # нужны только для подстановки в URL, поэтому и его не копируем. Тело,
+        # query и заголовки уходят в aiohttp, тот требует настоящий dict
+        if location == 'params':
+            url = self._make_url(
+                self._replace_path_params(
+                    template['path'],
+                    ChainMap({key: value}, template['params']),
+                )
+            )
+        elif location == 'query':
+            query = {**query, key: value}
+        elif location == 'json':
+            json = {**json, key: value}
+        else:
+            headers = {**headers, key: value}
+        return template['method'], url, query, json, headers
+
+    def _make_url(self, path: str) -> URL:
+        return self._base_url.with_path(self._base_path + path, encoded=True)
 
     def _fuzz_data(self, data: Any) -> Any:
         if isinstance(data, list):
-            return {x['name']: self._fuzz_data(x) for x in data}
+            # У каждой операции свой список параметров, но сами параметры
+            # берутся из схемы: общие параметры пути совпадают у всех ее
+            # операций, и значения для них генерируются один раз
+            key = tuple(map(id, data))
+            if key not in self._fuzz_cache:
+                self._fuzz_cache[key] = {
+                    x['name']: self._fuzz_data(x) for x in data
+                }
+            return self._fuzz_cache[key]
         if isinstance(data, dict):
-            if 'example' in data:
-                return data['example']
-            schema = data.get('schema', data)
-            if 'default' in schema:
-                return schema['default']
-            if 'enum' in schema:
-                return random.choice(schema['enum'])
-            match schema.get('type'):
-                case 'object':
-                    return {
-                        k: self._fuzz_data(v)
-                        for k, v in schema.get('properties', {}).items()
-                    }
-                case 'array':
-                    # minLength?
-                    return [self._fuzz_data(data['items'])]
-                case 'integer' | 'number':
-                    return random.randint(1, 100)
-                case 'boolean':
-                    return bool(random.randbytes(1))
-                case 'string':
-                    match schema.get('format'):
-                        case 'date':
-                            return str(random_datetime().date())
-                        case 'date-time':
-                            return str(random_datetime())
-                        case 'password':
-                            return 'T0p$3cR3t'
-                        case 'email':
-                            return 'j.doe@example.com'
-                        case 'uuid':
-                            return str(uuid.uuid4())
-                        case _:
-                            return random.choice(['foo', 'bar', 'baz', 'quix'])
+            # Одни и те же компоненты схемы используются во многих операциях.
+            # Узлы схемы живут все время сканирования, поэтому id() стабилен
+            if id(data) not in self._fuzz_cache:
+                self._fuzz_cache[id(data)] = self._fuzz_schema(data)
+            return self._fuzz_cache[id(data)]
+
+    def _fuzz_schema(self, data: dict[str, Any]) -> Any:
+        if 'example' in data:
+            return data['example']
+        # Параметры и тела запросов ссылаются на общие схемы компонентов:
+        # значение для схемы генерируется один раз на все сканирование
+        if 'schema' in data:
+            return self._fuzz_data(data['schema'])
+        schema = data
+        if 'default' in schema:
+            return schema['default']
+        if 'enum' in schema:
+            return self._rng.choice(schema['enum'])
+        match schema.get('type'):
+            case 'object':
+                return {
+                    k: self._fuzz_data(v)
+                    for k, v in schema.get('properties', {}).items()
+                }
+            case 'array':
+                # minLength?
+                return [self._fuzz_data(schema['items'])]
+            case 'integer' | 'number':
+                return self._rng.randint(1, 100)
+            case 'boolean':
+                return bool(self._rng.getrandbits(1))
+            case 'string':
+                match schema.get('format'):
+                    case 'date':
+                        return self._rng.choice(self._date_pool)
+                    case 'date-time':
+                        return self._rng.choice(self._datetime_pool)
+                    case 'password':
+                        return 'T0p$3cR3t'
+                    case 'email':
+                        return 'j.doe@example.com'
+                    case 'uuid':
+                        return self._rng.choice(self._uuid_pool)
+                    case _:
+                        return next(self._strings)
 
     def _inject(self, val: Any) -> str:
         return f"{val}'\""
 
-    def _replace_path_params(self, path: str, params: dict[str, Any]) -> str:
-        for k, v in params.items():
-            path = path.replace(f'{{{k}}}', urlparse.quote(str(v)))
-        return path
+    def _replace_path_params(self, path: str, params: Mapping[str, Any]) -> str:
+        # Шаблон разбирается один раз, а подставляется в каждой проверке
+        literals, names = self._compile_path(path)
+        # Большинство путей без параметров
+        if not names:
+            return literals[0]
+        rv = [literals[0]]
+        for name, literal in zip(names, literals[1:]):
+            rv.append(
+                self._quote(str(params[name]))
+                if name in params
+                else f'{{{name}}}'
+            )
+            rv.append(literal)
+        return ''.join(rv)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)
+    def _quote(value: str) -> str:
+        # Значения параметров пути повторяются во всех проверках операции
+        return urlparse.quote(value)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def _compile_path(path: str) -> tuple[tuple[str, ...], tuple[str, ...]]:
+        parts = OpenApiVulnScanner.PATH_PARAM_RE.split(path)
+        # Части с четными индексами - текст между параметрами. URL собирается
+        # с encoded=True, поэтому текст пути кодируем здесь же, один раз.
+        # Уже закодированные последовательности (%20) не трогаем
+        literals = tuple(
+            urlparse.quote(x, safe="/:@!$&'()*+,;=%") for x in parts[::2]
+        )
+        return literals, tuple(parts[1::2])
@@ -1,9 +1,75 @@
+import asyncio
 import datetime
+import json
 import random
+from typing import Any
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+MIN_DATETIME = datetime.datetime(1900, 1, 1, 0, 0, 0)
 
 
 def random_datetime(
-    start: datetime.datetime = datetime.datetime(1900, 1, 1, 0, 0, 0),
-    end: datetime.datetime = datetime.datetime.now(),
+    start: None | datetime.datetime = None,
+    end: None | datetime.datetime = None,
+    rng: None | random.Random = None,
 ) -> datetime.datetime:
-    return start + (end - start) * random.random()
+    # Значение по умолчанию вычисляется при импорте модуля, поэтому now()
+    # нельзя указывать в сигнатуре
+    start = start or MIN_DATETIME
+    end = end or datetime.datetime.now()
+    return start + (end - start) * (rng or random).random()
+
+
+def parse_content_type(value: str) -> str:
+    # Замена cgi.parse_header, который устарел и удален в 3.13: параметры
+    # вроде charset нам не нужны
+    return value.partition(';')[0].strip().lower()
+
+
+class TokenBucket:
+    """Ограничение числа запросов: rate в секунду, не больше capacity подряд"""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'last')
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = None
+
+    async def acquire(self) -> None:
+        # Все выполняется в одном потоке без await до резервирования, поэтому
+        # блокировка не нужна. Токены могут уйти в минус: каждый ожидающий
+        # резервирует свой токен и спит, пока он не накопится
+        now = asyncio.get_running_loop().time()
+        if self.last is not None:
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.last) * self.rate
+            )
+        self.last = now
+        self.tokens -= 1
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+
+if orjson:
+    json_loads = orjson.loads
+
+    def json_dumps_line(obj: Any) -> bytes:
+        # Перевод строки добавляется без лишнего копирования байтов
+        return orjson.dumps(obj, option=orjson.OPT_APPEND_NEWLINE)
+
+else:
+    json_loads = json.loads
+    # Компактный вывод в UTF-8 без \u-экранирования, как у orjson.
+    # Кодировщик создается один раз, а не при каждом вызове json.dumps с
+    # нестандартными параметрами
+    _json_encoder = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False)
+
+    def json_dumps_line(obj: Any) -> bytes:
+        return (_json_encoder.encode(obj) + '\n').encode()
@@ -1,4 +1,12 @@
+import asyncio
+from typing import Any
+
+import pytest
+
+from openapi_scanner.api import Dereferencer, Loader, OpenApi, SwaggerApi
 from openapi_scanner.cli import _parse_args
+from openapi_scanner.scanner import OpenApiVulnScanner
+from openapi_scanner.utils import TokenBucket
 
 
 def test_cli_args():
@@ -10,3 +18,188 @@ def test_cli_args():
         ]
     )
     print(args)
+
+
+class DictLoader(Loader):
+    def __init__(self, documents: dict[str, Any]):
+        super().__init__()
+        self._cache = documents
+
+
+def test_dereference():
+    schema = {
+        'paths': {
+            '/a': {'$ref': '#/components/Item'},
+            '/b': [{'$ref': '#/components/Item'}],
+        },
+        'components': {'Item': {'type': 'string'}},
+    }
+    loader = DictLoader({'https://fakeapi.com/openapi.json': schema})
+    rv = Dereferencer('https://fakeapi.com/openapi.json', loader).dereference()
+    assert rv['paths'] == {
+        '/a': {'type': 'string'},
+        '/b': [{'type': 'string'}],
+    }
+
+
+def test_dereference_circular():
+    schema = {'a': {'$ref': '#/b'}, 'b': {'c': {'$ref': '#/a'}}}
+    loader = DictLoader({'https://fakeapi.com/openapi.json': schema})
+    with pytest.raises(ValueError):
+        Dereferencer('https://fakeapi.com/openapi.json', loader).dereference()
+
+
+def test_loader_parse_bom():
+    loader = Loader.__new__(Loader)
+    assert loader._parse(b'\xef\xbb\xbf{"a": 1}', False, 'u') == {'a': 1}
+    assert loader._parse(b'\xef\xbb\xbfa: 1', True, 'u') == {'a': 1}
+
+
+def test_swagger_has_payload():
+    schema = {
+        'swagger': '2.0',
+        'paths': {
+            '/pets': {
+                'get': {'parameters': [{'name': 'q', 'in': 'query'}]},
+                'post': {'parameters': [{'name': 'pet', 'in': 'formData'}]},
+            }
+        },
+    }
+    api = SwaggerApi(schema, 'https://fakeapi.com/swagger.json')
+    assert not api.has_payload('/pets', 'get')
+    assert not api.has_formdata('/pets', 'get')
+    assert api.has_payload('/pets', 'post')
+    assert api.has_formdata('/pets', 'post')
+
+
+def test_replace_path_params():
+    scanner = OpenApiVulnScanner.__new__(OpenApiVulnScanner)
+    assert (
+        scanner._replace_path_params(
+            '/users/{user_id}/posts/{id}', {'id': "1'\"", 'user_id': 42}
+        )
+        == '/users/42/posts/1%27%22'
+    )
+    assert scanner._replace_path_params('/{unknown}', {}) == '/{unknown}'
+    assert (
+        scanner._replace_path_params('/files/{name} list/ä', {'name': 'a b'})
+        == '/files/a%20b%20list/%C3%A4'
+    )
+
+
+def test_normalize_url():
+    api = SwaggerApi({}, 'https://fakeapi.com/docs/swagger.json')
+    assert api.normalize_url('/v1/') == 'https://fakeapi.com/v1'
+    assert api.normalize_url('http://other.com/') == 'http://other.com'
+    assert api.normalize_url('v2') == 'https://fakeapi.com/docs/v2'
+    assert api.normalize_url('//cdn.com/x') == 'https://cdn.com/x'
+    api = SwaggerApi({'host': 'api.com'}, 'https://fakeapi.com/swagger.json')
+    assert api.get_server_urls() == ['https://api.com']
+
+
+def test_token_bucket():
+    async def acquire_all() -> float:
+        bucket = TokenBucket(rate=100, capacity=2)
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        await asyncio.gather(*(bucket.acquire() for _ in range(6)))
+        return loop.time() - start
+
+    # 2 запроса сразу, остальные 4 по одному в 10 мс
+    assert 0.035 < asyncio.run(acquire_all()) < 0.2
+
+
+def test_generate_tasks_skips_duplicates():
+    param = {'in': 'path', 'schema': {'type': 'integer', 'default': 1}}
+    schema = {
+        'openapi': '3.0.0',
+        'paths': {
+            '/items/{id}': {'get': {'parameters': [{'name': 'id', **param}]}},
+            '/items/{item_id}': {
+                'get': {'parameters': [{'name': 'item_id', **param}]}
+            },
+        },
+    }
+    scanner = OpenApiVulnScanner(
+        'https://fakeapi.com/openapi.json',
+        session=None,
+        openapi=OpenApi(schema, 'https://fakeapi.com/openapi.json'),
+    )
+    assert list(scanner._generate_tasks()) == [(0, 'params', 'id', "1'\"")]
+
+
+def test_generate_tasks_keeps_different_requests():
+    def params(name, sort):
+        return [
+            {'name': name, 'in': 'path', 'schema': {'example': 1}},
+            {'name': 'q', 'in': 'query', 'schema': {'example': 'x'}},
+            {'name': 'sort', 'in': 'query', 'schema': {'example': sort}},
+        ]
+
+    schema = {
+        'openapi': '3.0.0',
+        'paths': {
+            '/items/{id}': {'get': {'parameters': params('id', 'asc')}},
+            '/items/{item_id}': {
+                'get': {'parameters': params('item_id', 'desc')}
+            },
+        },
+    }
+    scanner = OpenApiVulnScanner(
+        'https://fakeapi.com/openapi.json',
+        session=None,
+        openapi=OpenApi(schema, 'https://fakeapi.com/openapi.json'),
+    )
+    # Запросы отличаются значением sort, поэтому q проверяется в обоих
+    assert (1, 'query', 'q', "x'\"") in list(scanner._generate_tasks())
+
+
+def test_fuzz_data():
+    scanner = OpenApiVulnScanner(
+        'https://fakeapi.com/openapi.json',
+        session=None,
+        openapi=OpenApi(
+            {'openapi': '3.0.0'}, 'https://fakeapi.com/openapi.json'
+        ),
+    )
+    # Значения кешируются по id() узлов схемы, поэтому узлы должны жить до
+    # конца теста, как живет схема во время сканирования
+    example = [{'name': 'q', 'in': 'query', 'schema': {'example': 'foo'}}]
+    assert scanner._fuzz_data(example) == {'q': 'foo'}
+    array = [
+        {
+            'name': 'ids',
+            'in': 'query',
+            'schema': {'type': 'array', 'items': {'default': 7}},
+        }
+    ]
+    assert scanner._fuzz_data(array) == {'ids': [7]}
+    # Общая схема компонента получает одно значение во всех параметрах
+    shared = {'type': 'string', 'format': 'uuid'}
+    params = [
+        {'name': 'a', 'in': 'query', 'schema': shared},
+        {'name': 'b', 'in': 'header', 'schema': shared},
+    ]
+    values = scanner._fuzz_data(params)
+    assert values['a'] == values['b']
+
+
+def test_select_body_fields():
+    scanner = OpenApiVulnScanner.__new__(OpenApiVulnScanner)
+    scanner._max_body_fields = 2
+    schema = {
+        'schema': {
+            'type': 'object',
+            'properties': {
+                'width': {'type': 'integer'},
+                'valid': {'type': 'string'},
+                'note': {'type': 'string'},
+                'active': {'type': 'boolean'},
+                'role': {'type': 'string', 'enum': ['admin', 'user']},
+                'title': {'type': 'string'},
+                'user_id': {'type': 'integer'},
+            },
+        }
+    }
+    fields = dict.fromkeys(schema['schema']['properties'], 'x')
+    assert scanner._select_body_fields(schema, fields) == ['user_id', 'width']